@@ -0,0 +1,163 @@
+# app/diffusion/bench_preview.py
+"""
+미리보기 스트리밍이 전체 생성 시간에 더하는 오버헤드 측정용 벤치마크.
+
+같은 프롬프트 / 같은 seed 로 미리보기 off(preview_every=0) 와
+preview_every = 1 / 5 / 10 을 각각 여러 번 돌려 총 생성 시간을 비교한다.
+
+실행 (project1 디렉터리에서):
+    python -m app.diffusion.bench_preview --runs 5   # 전체 A/B (GPU 권장)
+    python -m app.diffusion.bench_preview --micro    # 미리보기 변환만 (모델 불필요)
+    python -m app.diffusion.bench_preview --check    # x0 역산 self-check
+"""
+import argparse
+import statistics
+import time
+
+import torch
+from diffusers import EulerAncestralDiscreteScheduler, EulerDiscreteScheduler
+
+from app.diffusion.sd_client import (
+    GENERATED_DIR,
+    _device,
+    _estimate_clean_latents,
+    _latents_to_preview,
+    generate_image_stream,
+)
+
+DEFAULT_PROMPT = "a friendly cartoon fox reading a picture book under a tree, children's book illustration"
+
+
+def _run_once(prompt: str, seed: int, steps: int, preview_every: int) -> dict:
+    timing = None
+    for event in generate_image_stream(
+        prompt,
+        num_inference_steps=steps,
+        seed=seed,
+        preview_every=preview_every,
+    ):
+        if event["type"] == "error":
+            raise RuntimeError(event["error"])
+        if event["type"] == "done":
+            timing = event["timing"]
+            # 벤치마크 결과물은 남기지 않는다
+            (GENERATED_DIR / event["imageUrl"].rsplit("/", 1)[-1]).unlink(missing_ok=True)
+    return timing
+
+
+def _check_estimate_clean_latents() -> None:
+    """
+    x0 를 알고 있는 합성 오일러 스텝으로 _estimate_clean_latents 역산을 검증
+    """
+    torch.manual_seed(0)
+    scheduler = EulerDiscreteScheduler()
+    scheduler.set_timesteps(30)
+
+    x0 = torch.randn(1, 4, 128, 128)
+    for index in (0, 5, 15, 28):
+        sigma = float(scheduler.sigmas[index])
+        sample = x0 + sigma * torch.randn_like(x0)
+        # epsilon 예측: pred_original = sample - sigma * model_output 이 x0 가 되도록
+        model_output = (sample - x0) / sigma
+
+        scheduler._step_index = None
+        next_sample = scheduler.step(
+            model_output, scheduler.timesteps[index], sample
+        ).prev_sample
+
+        estimate = _estimate_clean_latents(scheduler, next_sample, sample)
+        error = (estimate - x0).abs().max().item()
+        print(f"euler step {index:>2}: sigma={sigma:8.4f} max |x0 - estimate| = {error:.2e}")
+        assert error < 1e-3, f"x0 estimate off at step {index}: {error}"
+
+    # 오일러가 아닌 스케줄러는 x0 역산 없이 1/sqrt(sigma^2 + 1) 스케일만 적용
+    other = EulerAncestralDiscreteScheduler()
+    other.set_timesteps(30)
+    other._step_index = 5
+    latents = torch.randn(1, 4, 128, 128)
+    sigma = float(other.sigmas[5])
+    expected = latents / (sigma ** 2 + 1) ** 0.5
+    assert torch.allclose(_estimate_clean_latents(other, latents, latents), expected)
+
+    print("ok")
+
+
+def _run_micro(runs: int) -> None:
+    """
+    모델 없이 4x128x128 latent (1024x1024 생성 기준) 하나를
+    x0 추정 + RGB 근사 + JPEG 인코딩하는 시간만 측정
+    """
+    scheduler = EulerDiscreteScheduler()
+    scheduler.set_timesteps(30)
+    scheduler._step_index = 5
+
+    prev = torch.randn(1, 4, 128, 128, device=_device)
+    latents = torch.randn(1, 4, 128, 128, device=_device)
+
+    timings = []
+    for _ in range(runs + 1):
+        if _device == "cuda":
+            torch.cuda.synchronize()
+        started = time.perf_counter()
+        _latents_to_preview(_estimate_clean_latents(scheduler, latents, prev))
+        timings.append((time.perf_counter() - started) * 1000)
+
+    # 첫 실행은 워밍업
+    timings = timings[1:]
+    print(f"device={_device} runs={runs}")
+    print(
+        f"preview decode ms: median={statistics.median(timings):.2f} "
+        f"min={min(timings):.2f} max={max(timings):.2f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="SDXL preview overhead benchmark")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--preview-every", type=int, nargs="+", default=[0, 1, 5, 10])
+    parser.add_argument("--micro", action="store_true", help="preview decode only, no model")
+    parser.add_argument("--check", action="store_true", help="verify x0 estimate")
+    args = parser.parse_args()
+
+    if args.check:
+        _check_estimate_clean_latents()
+        return
+
+    if args.micro:
+        _run_micro(max(args.runs, 20))
+        return
+
+    # 모델 로딩 / CUDA 워밍업은 측정에서 제외
+    _run_once(args.prompt, args.seed, args.steps, 0)
+
+    results: dict[int, list[dict]] = {}
+    for preview_every in args.preview_every:
+        results[preview_every] = [
+            _run_once(args.prompt, args.seed, args.steps, preview_every)
+            for _ in range(args.runs)
+        ]
+
+    baseline = None
+    if 0 in results:
+        baseline = statistics.median(t["totalMs"] for t in results[0])
+
+    print(f"steps={args.steps} seed={args.seed} runs={args.runs}")
+    print("preview_every | median total ms | overhead vs off | previews | median preview ms | median sync ms")
+    for preview_every, timings in results.items():
+        total = statistics.median(t["totalMs"] for t in timings)
+        overhead = (
+            f"{(total - baseline) / baseline * 100:+.2f}%" if baseline else "-"
+        )
+        print(
+            f"{preview_every or 'off':>13} | {total:>15.1f} | {overhead:>15} | "
+            f"{timings[0]['previewCount']:>8} | "
+            f"{statistics.median(t['previewMs'] for t in timings):>17.1f} | "
+            f"{statistics.median(t['previewSyncMs'] for t in timings):>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
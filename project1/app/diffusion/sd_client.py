@@ -1,49 +1,84 @@
 # app/diffusion/sd_client.py
 import os
+import io
+import time
+import base64
+import queue
+import threading
 from uuid import uuid4
 from pathlib import Path
+from typing import Iterator
 
 import torch
-from diffusers import StableDiffusionXLPipeline
+from diffusers import StableDiffusionXLPipeline, EulerDiscreteScheduler
 from PIL import Image
 
 from app.config import SD_MODEL_ID
 
 _device = "cuda" if torch.cuda.is_available() else "cpu"
 _pipe: StableDiffusionXLPipeline | None = None
+# 스트리밍 생성은 별도 스레드에서 돌기 때문에 파이프라인 동시 호출을 막는다
+_pipe_lock = threading.Lock()
+_pipe_init_lock = threading.Lock()
 
 BASE_DIR = Path(__file__).resolve().parents[2]
 GENERATED_DIR = BASE_DIR / "app" / "static" / "generated"
 
+NEGATIVE_PROMPT = (
+    "deformed face, distorted face, asymmetrical face, extra eyes, extra limbs, "
+    "extra fingers, long neck, disfigured, mutated, low quality, blurry, distorted, "
+    "text, cropped, ugly, disfigured, poor anatomy, missing limbs, malformed hands, "
+    "poorly drawn eyes, unsettling, monochrome, grayscale, realistic, photography, photo"
+)
+
+# SDXL latent(4ch) → RGB 근사 선형 변환 계수
+# VAE decode 없이 중간 latent를 저해상도 미리보기로 바꿀 때 사용
+_SDXL_LATENT_RGB_FACTORS = [
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+_SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
 def _get_pipeline() -> StableDiffusionXLPipeline:
     global _pipe
 
     if _pipe is None:
-        if not SD_MODEL_ID:
-            raise RuntimeError("SD_MODEL_ID is not set or empty")
+        # 여러 요청이 스레드풀에서 동시에 들어와도 파이프라인은 한 번만 로드
+        with _pipe_init_lock:
+            if _pipe is None:
+                _pipe = _load_pipeline()
 
-        dtype = torch.float16 if _device == "cuda" else torch.float32
+    return _pipe
 
-        print("[SDXL] Loading pipeline from:", SD_MODEL_ID)
 
-        _pipe = StableDiffusionXLPipeline.from_pretrained(
-            SD_MODEL_ID,
-            torch_dtype=dtype,
-            use_safetensors=True,
-            variant="fp16",
-        ).to(_device)
+def _load_pipeline() -> StableDiffusionXLPipeline:
+    if not SD_MODEL_ID:
+        raise RuntimeError("SD_MODEL_ID is not set or empty")
 
-        try:
-            _pipe.enable_attention_slicing()
-        except Exception:
-            pass
+    dtype = torch.float16 if _device == "cuda" else torch.float32
 
-        try:
-            _pipe.enable_vae_tiling()
-        except Exception:
-            pass
+    print("[SDXL] Loading pipeline from:", SD_MODEL_ID)
 
-    return _pipe
+    pipe = StableDiffusionXLPipeline.from_pretrained(
+        SD_MODEL_ID,
+        torch_dtype=dtype,
+        use_safetensors=True,
+        variant="fp16",
+    ).to(_device)
+
+    try:
+        pipe.enable_attention_slicing()
+    except Exception:
+        pass
+
+    try:
+        pipe.enable_vae_tiling()
+    except Exception:
+        pass
+
+    return pipe
 
 
 def generate_image_from_prompt(
@@ -62,37 +97,280 @@ def generate_image_from_prompt(
     """
     pipe = _get_pipeline()
 
-    # 출력 디렉터리 보장
-    GENERATED_DIR.mkdir(parents=True, exist_ok=True)
+    with _pipe_lock:
+        result = pipe(
+            **_build_pipeline_kwargs(
+                prompt, num_inference_steps, guidance_scale, seed, width, height
+            )
+        )
+
+    image: Image.Image = result.images[0]
+
+    return _save_generated_image(image)
+
 
+def _build_pipeline_kwargs(
+    prompt: str,
+    num_inference_steps: int,
+    guidance_scale: float,
+    seed: int | None,
+    width: int,
+    height: int,
+) -> dict:
     generator = None
     if seed is not None:
         generator = torch.Generator(device=_device).manual_seed(seed)
 
-    negative_prompt = (
-        "deformed face, distorted face, asymmetrical face, extra eyes, extra limbs, "
-        "extra fingers, long neck, disfigured, mutated, low quality, blurry, distorted, "
-        "text, cropped, ugly, disfigured, poor anatomy, missing limbs, malformed hands, "
-        "poorly drawn eyes, unsettling, monochrome, grayscale, realistic, photography, photo"
-    )
+    return {
+        "prompt": prompt,
+        "negative_prompt": NEGATIVE_PROMPT,
+        "num_inference_steps": num_inference_steps,
+        "guidance_scale": guidance_scale,
+        "width": width,
+        "height": height,
+        "generator": generator,
+    }
 
-    result = pipe(
-        prompt=prompt,
-        negative_prompt=negative_prompt,
-        num_inference_steps=num_inference_steps,
-        guidance_scale=guidance_scale,
-        width=width,
-        height=height,
-        generator=generator,
-    )
 
-    image: Image.Image = result.images[0]
+def _save_generated_image(image: Image.Image) -> str:
+    # 출력 디렉터리 보장
+    GENERATED_DIR.mkdir(parents=True, exist_ok=True)
 
     filename = f"{uuid4().hex}.png"
     filepath = GENERATED_DIR / filename   # 로컬 경로
     image.save(str(filepath))
-    
+
     url_path = f"/static/generated/{filename}"  # 프론트에서 쓸 URL
 
     return url_path
 
+
+def _decode_latents(pipe: StableDiffusionXLPipeline, latents: torch.Tensor) -> Image.Image:
+    """
+    output_type="latent" 로 받은 latent를 파이프라인과 같은 방식으로 VAE decode.
+    취소 여부를 확인한 뒤에만 full-res decode 를 하기 위해 분리했다.
+    """
+    vae = pipe.vae
+
+    # SDXL fp16 VAE는 오버플로가 있어 파이프라인도 decode 때만 fp32로 올린다
+    needs_upcasting = vae.dtype == torch.float16 and vae.config.force_upcast
+    if needs_upcasting:
+        pipe.upcast_vae()
+        latents = latents.to(next(iter(vae.post_quant_conv.parameters())).dtype)
+    elif latents.dtype != vae.dtype:
+        latents = latents.to(vae.dtype)
+
+    latents_mean = getattr(vae.config, "latents_mean", None)
+    latents_std = getattr(vae.config, "latents_std", None)
+    if latents_mean is not None and latents_std is not None:
+        latents_mean = torch.tensor(latents_mean).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+        latents_std = torch.tensor(latents_std).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+        latents = latents * latents_std / vae.config.scaling_factor + latents_mean
+    else:
+        latents = latents / vae.config.scaling_factor
+
+    with torch.no_grad():
+        image = vae.decode(latents, return_dict=False)[0]
+
+    if needs_upcasting:
+        vae.to(dtype=torch.float16)
+
+    if getattr(pipe, "watermark", None) is not None:
+        image = pipe.watermark.apply_watermark(image)
+
+    return pipe.image_processor.postprocess(image, output_type="pil")[0]
+
+
+def _estimate_clean_latents(
+    scheduler,
+    latents: torch.Tensor,
+    prev_latents: torch.Tensor | None,
+) -> torch.Tensor:
+    """
+    스텝 콜백 시점의 latent는 x0 + sigma * noise 상태라 그대로 RGB 변환하면
+    초반 미리보기가 노이즈로 포화된다.
+
+    - EulerDiscreteScheduler(SDXL 기본) + 직전 스텝 latent가 있으면
+      오일러 스텝을 역산해서 x0를 추정
+    - 그 외 스케줄러는 x0 추정이 아니라 1/sqrt(sigma^2 + 1) 로 크기만 맞춘다.
+      이 경우 초반 미리보기에는 노이즈가 그대로 남는다.
+    """
+    sigmas = getattr(scheduler, "sigmas", None)
+    step_index = getattr(scheduler, "step_index", None)
+    if sigmas is None or step_index is None:
+        return latents
+
+    # 콜백은 scheduler.step 이후에 불리므로 step_index 는 이미 다음 스텝을 가리킨다
+    sigma_next = float(sigmas[step_index])
+
+    if (
+        isinstance(scheduler, EulerDiscreteScheduler)
+        and prev_latents is not None
+        and step_index > 0
+    ):
+        sigma = float(sigmas[step_index - 1])
+        if sigma != sigma_next:
+            # x_next = x + (x - x0) / sigma * (sigma_next - sigma) 를 x0 에 대해 푼 식
+            return prev_latents - (latents - prev_latents) * sigma / (sigma_next - sigma)
+
+    return latents / (sigma_next ** 2 + 1) ** 0.5
+
+
+def _latents_to_preview(latents: torch.Tensor, size: int = 256) -> str:
+    """
+    latent(4 x H/8 x W/8)를 VAE 없이 선형 변환으로 RGB로 근사하고,
+    긴 변이 size 픽셀이 되도록 리사이즈한 JPEG data URL로 반환
+    (1024x1024 생성이면 latent는 128x128 이라 256 이면 2배 확대)
+
+    계수는 깨끗한 latent(x0) 기준이므로 _estimate_clean_latents 를 거친 값을 넘긴다.
+    초반 스텝 미리보기는 노이즈가 남은 latent의 근사치일 뿐이다.
+    """
+    latent = latents[0].detach().float()
+    factors = torch.tensor(_SDXL_LATENT_RGB_FACTORS, device=latent.device)
+    bias = torch.tensor(_SDXL_LATENT_RGB_BIAS, device=latent.device)
+
+    # (4, h, w) → (h, w, 3)
+    rgb = torch.einsum("chw,cr->hwr", latent, factors) + bias
+    rgb = ((rgb + 1.0) / 2.0).clamp(0, 1).mul(255).byte().cpu().numpy()
+
+    image = Image.fromarray(rgb)
+    scale = size / max(image.size)
+    image = image.resize(
+        (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+        Image.BILINEAR,
+    )
+
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=70)
+    encoded = base64.b64encode(buf.getvalue()).decode("ascii")
+    return f"data:image/jpeg;base64,{encoded}"
+
+
+def generate_image_stream(
+    prompt: str,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 10.0,
+    seed: int | None = None,
+    width: int = 1024,
+    height: int = 1024,
+    preview_every: int = 5,
+    preview_size: int = 256,
+    cancel: threading.Event | None = None,
+) -> Iterator[dict]:
+    """
+    generate_image_from_prompt 와 같은 이미지를 만들되,
+    preview_every 스텝마다 중간 latent 미리보기 이벤트를 먼저 내보낸다.
+    preview_every 가 0 이면 미리보기 없이 생성만 한다 (벤치마크 기준선 용).
+
+    이벤트:
+    - {"type": "preview", "step", "totalSteps", "image"(data URL)}
+    - {"type": "done", "imageUrl", "timing"}
+    - {"type": "error", "error"}
+
+    timing 의 previewMs 는 미리보기 변환 자체에 쓴 시간,
+    previewSyncMs 는 그 전에 밀린 GPU 작업(UNet 등)을 기다린 시간이다.
+    둘 다 미리보기가 전체 생성 시간에 더하는 오버헤드 자체는 아니며,
+    실제 오버헤드는 app.diffusion.bench_preview 로 미리보기 on/off 를 비교해서 잰다.
+
+    cancel 이 set 되거나 소비하는 쪽이 제너레이터를 닫으면
+    다음 스텝에서 디노이징을 멈추고 VAE decode / 저장 없이 끝낸다.
+    """
+    pipe = _get_pipeline()
+    events: queue.Queue = queue.Queue()
+    cancel = cancel or threading.Event()
+    preview_every = max(0, preview_every)
+    preview_seconds = 0.0
+    preview_sync_seconds = 0.0
+    preview_count = 0
+    prev_latents: torch.Tensor | None = None
+
+    def is_preview_step(done_steps: int) -> bool:
+        return (
+            preview_every > 0
+            and done_steps % preview_every == 0
+            and done_steps < num_inference_steps
+        )
+
+    def on_step_end(pipeline, step: int, timestep, callback_kwargs: dict) -> dict:
+        nonlocal preview_seconds, preview_sync_seconds, preview_count, prev_latents
+
+        if cancel.is_set():
+            # diffusers >= 0.27: 남은 스텝은 건너뛴다
+            if hasattr(pipeline, "_interrupt"):
+                pipeline._interrupt = True
+            return callback_kwargs
+
+        latents = callback_kwargs["latents"]
+        done_steps = step + 1
+        if is_preview_step(done_steps):
+            if _device == "cuda":
+                # 밀린 UNet 커널이 미리보기 시간에 섞이지 않도록 먼저 동기화
+                sync_started = time.perf_counter()
+                torch.cuda.synchronize()
+                preview_sync_seconds += time.perf_counter() - sync_started
+
+            started = time.perf_counter()
+            clean = _estimate_clean_latents(pipeline.scheduler, latents, prev_latents)
+            image = _latents_to_preview(clean, preview_size)
+            preview_seconds += time.perf_counter() - started
+            preview_count += 1
+            events.put({
+                "type": "preview",
+                "step": done_steps,
+                "totalSteps": num_inference_steps,
+                "image": image,
+            })
+
+        # 다음 스텝이 미리보기 스텝이면 x0 역산용으로 현재 latent 보관
+        prev_latents = latents.clone() if is_preview_step(done_steps + 1) else None
+        return callback_kwargs
+
+    def worker() -> None:
+        try:
+            with _pipe_lock:
+                # 락을 기다리는 동안 클라이언트가 떠났으면 아예 돌리지 않는다
+                if cancel.is_set():
+                    print("[SDXL] stream cancelled before start")
+                    return
+
+                started = time.perf_counter()
+                result = pipe(
+                    **_build_pipeline_kwargs(
+                        prompt, num_inference_steps, guidance_scale, seed, width, height
+                    ),
+                    output_type="latent",
+                    callback_on_step_end=on_step_end,
+                    callback_on_step_end_tensor_inputs=["latents"],
+                )
+                if cancel.is_set():
+                    print("[SDXL] stream cancelled, skipping VAE decode")
+                    return
+
+                image = _decode_latents(pipe, result.images)
+
+            url_path = _save_generated_image(image)
+            total_seconds = time.perf_counter() - started
+
+            timing = {
+                "totalMs": round(total_seconds * 1000, 1),
+                "previewMs": round(preview_seconds * 1000, 1),
+                "previewSyncMs": round(preview_sync_seconds * 1000, 1),
+                "previewCount": preview_count,
+            }
+            print("[SDXL] stream timing:", timing)
+            events.put({"type": "done", "imageUrl": url_path, "timing": timing})
+        except Exception as e:
+            events.put({"type": "error", "error": str(e)})
+        finally:
+            events.put(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    try:
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield event
+    finally:
+        cancel.set()
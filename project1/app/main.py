@@ -1,9 +1,12 @@
 # app/main.py
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 
 import json
+import threading
 
 from app.ocr.azure_ocr import extract_text_from_image
 from app.llm.gemini_client import (
@@ -12,7 +15,7 @@ from app.llm.gemini_client import (
         build_chat_reaction,
         summarize_chat_history,
         )
-from app.diffusion.sd_client import generate_image_from_prompt
+from app.diffusion.sd_client import generate_image_from_prompt, generate_image_stream
 from app.vision.azure_cv_client import detect_objects_from_image_url
 
 import traceback
@@ -62,7 +65,8 @@ async def process_page(
         print("ocr_text: ", ocr_text)
         sd_prompt = build_sd_prompt_from_text(ocr_text)
         print("sd_prompt: ", sd_prompt)
-        image_url = generate_image_from_prompt(sd_prompt)
+        # 스트리밍 생성이 파이프라인 락을 잡고 있어도 이벤트 루프가 막히지 않도록 스레드에서 실행
+        image_url = await run_in_threadpool(generate_image_from_prompt, sd_prompt)
         print("iamge_url: ", image_url)
         objects = detect_objects_from_image_url(image_url)
         print("objects detected")
@@ -81,6 +85,51 @@ async def process_page(
         return { "error": str(e) }
 
 
+# ---------------------------
+# 2-1. 페이지 전체 처리 (미리보기 스트리밍)
+#    POST /api/process-page/stream  (multipart: file, previewEvery)
+#    Response: NDJSON 스트림
+#      {"type": "prompt", "ocrText", "sd_prompt"}
+#      {"type": "preview", "step", "totalSteps", "image"}
+#      {"type": "done", "imageUrl", "objects", "aiQuestion", "timing"}
+#      {"type": "error", "error"}
+# ---------------------------
+@app.post("/api/process-page/stream")
+async def process_page_stream(
+        request: Request,
+        file: UploadFile = File(...),
+        preview_every: int = Form(5, alias="previewEvery")):
+    try:
+        image_bytes = await file.read()
+        ocr_text = extract_text_from_image(image_bytes)
+        print("ocr_text: ", ocr_text)
+        sd_prompt = build_sd_prompt_from_text(ocr_text)
+        print("sd_prompt: ", sd_prompt)
+    except Exception as e:
+        print("[/api/process-page/stream] ERROR:", repr(e))
+        return { "error": str(e) }
+
+    if preview_every < 1:
+        preview_every = 5
+
+    def on_done(event: dict) -> None:
+        print("streamed image_url: ", event["imageUrl"])
+        event["objects"] = detect_objects_from_image_url(event["imageUrl"])
+        print("objects detected")
+        event["aiQuestion"] = build_ai_question(ocr_text)
+        print("ai_question: ", event["aiQuestion"])
+
+    async def event_stream():
+        # 프롬프트는 이미지보다 먼저 보여줄 수 있으니 첫 이벤트로 보낸다
+        yield _ndjson({"type": "prompt", "ocrText": ocr_text, "sd_prompt": sd_prompt})
+        async for line in _stream_generation(
+            request, sd_prompt, preview_every, on_done, "/api/process-page/stream"
+        ):
+            yield line
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
 # ---------------------------
 # 3. 그림 재생성
 # ---------------------------
@@ -90,7 +139,7 @@ async def regenerate_image(payload: dict):
         prompt = payload.get("prompt")
         if not prompt or not isinstance(prompt, str):
             return {"error": "prompt 필드는 문자열로 반드시 포함되어야 합니다."}
-        image_url = generate_image_from_prompt(prompt)
+        image_url = await run_in_threadpool(generate_image_from_prompt, prompt)
         print("regenerated iamge_url: ", image_url)
         objects = detect_objects_from_image_url(image_url)
         print("objects detected")
@@ -104,6 +153,82 @@ async def regenerate_image(payload: dict):
         return { "error": str(e) }
 
 
+# ---------------------------
+# 3-1. 그림 재생성 (미리보기 스트리밍)
+#    POST /api/regenerate-image/stream
+#    Request: { "prompt": "...", "previewEvery": 5 }
+#    Response: NDJSON 스트림 (한 줄에 이벤트 하나)
+#      {"type": "preview", "step", "totalSteps", "image"}
+#      {"type": "done", "imageUrl", "objects", "timing"}
+#      {"type": "error", "error"}
+# ---------------------------
+@app.post("/api/regenerate-image/stream")
+async def regenerate_image_stream(request: Request, payload: dict):
+    prompt = payload.get("prompt")
+    if not prompt or not isinstance(prompt, str):
+        return {"error": "prompt 필드는 문자열로 반드시 포함되어야 합니다."}
+
+    preview_every = payload.get("previewEvery", 5)
+    if not isinstance(preview_every, int) or preview_every < 1:
+        preview_every = 5
+
+    def on_done(event: dict) -> None:
+        print("streamed image_url: ", event["imageUrl"])
+        event["objects"] = detect_objects_from_image_url(event["imageUrl"])
+        print("objects detected")
+
+    return StreamingResponse(
+        _stream_generation(
+            request, prompt, preview_every, on_done, "/api/regenerate-image/stream"
+        ),
+        media_type="application/x-ndjson",
+    )
+
+
+def _ndjson(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+async def _stream_generation(
+        request: Request,
+        prompt: str,
+        preview_every: int,
+        on_done,
+        endpoint: str,
+        ):
+    """
+    generate_image_stream 이벤트를 NDJSON 줄로 내보내는 async 제너레이터.
+    - 동기 제너레이터는 스레드풀에서 한 이벤트씩 꺼낸다
+    - done 이벤트는 on_done(event) 로 응답 필드를 채운 뒤 내보낸다
+    - 클라이언트가 끊기거나 응답 태스크가 취소되면 cancel 을 set 해서
+      다음 디노이징 스텝에서 생성을 멈춘다
+    """
+    cancel = threading.Event()
+    stream = generate_image_stream(prompt, preview_every=preview_every, cancel=cancel)
+    try:
+        while True:
+            if await request.is_disconnected():
+                print(f"[{endpoint}] client disconnected, cancelling")
+                break
+
+            event = await run_in_threadpool(next, stream, None)
+            if event is None:
+                break
+
+            if event["type"] == "error":
+                print(f"[{endpoint}] ERROR:", event["error"])
+            elif event["type"] == "done":
+                await run_in_threadpool(on_done, event)
+            yield _ndjson(event)
+
+    except Exception as e:
+        print(f"[{endpoint}] ERROR:", repr(e))
+        yield _ndjson({"type": "error", "error": str(e)})
+    finally:
+        # 스트림이 스레드풀에서 실행 중일 수 있어 close() 대신 cancel 로 알린다
+        cancel.set()
+
+
 # ---------------------------
 # 4. 채팅 API (아이 답장 → 리액션)
 #    POST /api/chat